@@ -4,12 +4,17 @@ pull in several optional dependencies as well.  The external Graphviz library
 is also required.
 """
 
+import os
+import subprocess
+import tempfile
+from functools import lru_cache
 from pathlib import Path
-from collections import defaultdict
-from io import BytesIO, IOBase
+from io import BytesIO, StringIO
+
+import attr
 
 from .deps.optdep import import_optional_dependency
-from .utils.misc import rewrap_docstring
+from .utils.misc import n_present, oneline, rewrap_docstring
 
 module_purpose = "rendering the flow DAG"
 hsluv = import_optional_dependency("hsluv", purpose=module_purpose)
@@ -17,59 +22,306 @@ pydot = import_optional_dependency("pydot", purpose=module_purpose)
 Image = import_optional_dependency("PIL.Image", purpose=module_purpose)
 
 
+def run_graphviz(dot_source, output_formats):
+    """
+    Renders a string of DOT source code into each of the specified output formats
+    (like "png" or "svg") by passing it to Graphviz's ``dot`` program, and returns a
+    dict mapping each format to its rendered bytes.
+
+    All the formats are rendered by a single ``dot`` process, so the graph layout
+    (which is usually the most expensive part) is only computed once.
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir_name:
+        paths_by_format = {
+            output_format: Path(tmp_dir_name) / f"graph.{output_format}"
+            for output_format in output_formats
+        }
+        args = ["dot"]
+        for output_format, path in paths_by_format.items():
+            args.append(f"-T{output_format}")
+            args.append(f"-o{path}")
+
+        process = subprocess.run(
+            args,
+            input=dot_source.encode("utf8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if process.returncode != 0:
+            message = f"""
+            Graphviz failed to render the DOT source as {list(output_formats)!r}
+            (exit code {process.returncode}):
+            {process.stderr.decode("utf8", errors="replace")}
+            """
+            raise RuntimeError(oneline(message))
+
+        return {
+            output_format: path.read_bytes()
+            for output_format, path in paths_by_format.items()
+        }
+
+
 class FlowImage:
-    def __init__(self, pydot_graph):
+    def __init__(self, pydot_graph=None, dot_source=None):
+        """
+        Given a pydot graph object or a string of DOT source code, create Pillow Image
+        or SVG represented as XML text. Replicates the PIL APIs for save and show, for
+        both PIL-supported and SVG formats.
+
+        Each representation is rendered lazily the first time it's needed, since
+        every render invokes Graphviz (which can be slow for large graphs).
+        """
+        if n_present(pydot_graph, dot_source) != 1:
+            raise ValueError(
+                "Exactly one of pydot_graph and dot_source should be provided"
+            )
+        if dot_source is None:
+            dot_source = pydot_graph.to_string()
+        self._dot_source = dot_source
+        self._cached_png_bytes = None
+        self._cached_pil_image = None
+        self._cached_xml_bytes = None
+
+    @classmethod
+    def from_dot_iter(cls, dot_lines):
         """
-        Given a pydot graph object, create Pillow Image or SVG represented as XML text.
-        Replicates the PIL APIs for save and show, for both PIL-supported and SVG formats.
+        Creates a FlowImage from an iterable of strings which together make up DOT
+        source code, like the one returned by ``dot_lines_from_graph``.
+
+        The lines are collected into a single string, which the image keeps for as
+        long as it exists, since each format is rendered from it lazily.
         """
-        self._pil_image = Image.open(BytesIO(pydot_graph.create_png()))
-        self._xml_bytes = pydot_graph.create_svg()
+        return cls(dot_source=dot_source_from_lines(dot_lines))
+
+    @property
+    def _png_bytes(self):
+        if self._cached_png_bytes is None:
+            # Rendering the SVG along with the PNG adds very little work, since the
+            # graph layout is shared; this way, any later SVG output is free.
+            output_formats = ["png"]
+            if self._cached_xml_bytes is None:
+                output_formats.append("svg")
+            bytes_by_format = run_graphviz(self._dot_source, output_formats)
+            if self._cached_xml_bytes is None:
+                self._cached_xml_bytes = bytes_by_format["svg"]
+            self._cached_png_bytes = bytes_by_format["png"]
+        return self._cached_png_bytes
+
+    @property
+    def _pil_image(self):
+        if self._cached_pil_image is None:
+            # Wrapping the rendered bytes directly gives us a buffer of exactly the
+            # right size, without any copying.
+            self._cached_pil_image = Image.open(BytesIO(self._png_bytes))
+        return self._cached_pil_image
+
+    @property
+    def _xml_bytes(self):
+        if self._cached_xml_bytes is None:
+            self._cached_xml_bytes = run_graphviz(self._dot_source, ["svg"])["svg"]
+        return self._cached_xml_bytes
 
     def save(self, fp, format=None, **params):
         """
         Save flow visualization to filename, Path, or file object. If file object is passed,
         must also pass format. Pass additional keyword options supported by PIL using params.
+        SVG output is written directly from Graphviz, without rendering a PNG or decoding
+        it with PIL; PNG output without any params is written directly from Graphviz
+        too.
         Args:
             fp: Filename (string), pathlib.Path object, or file object
             format: format parameters
             **params: additional keyword options supported by PIL
         """
-        is_file_object = isinstance(fp, IOBase)
-        use_svg = (format == "svg") or (
-            format is None and not is_file_object and Path(fp).suffix == ".svg"
+        # We check for a `write` method rather than an `IOBase` instance, since many
+        # file-like objects (like gzip streams or custom wrappers) aren't subclasses of
+        # `IOBase`.
+        is_file_object = hasattr(fp, "write")
+        if format is not None:
+            lowercase_format = format.lower()
+        else:
+            lowercase_format = None
+        if format is None and not is_file_object:
+            lowercase_path_str = os.fspath(fp).lower()
+        else:
+            lowercase_path_str = ""
+        use_svg = (lowercase_format == "svg") or lowercase_path_str.endswith(".svg")
+        use_graphviz_png = not params and (
+            (lowercase_format == "png") or lowercase_path_str.endswith(".png")
         )
         if use_svg:
-            if is_file_object:
-                fp.write(self._xml_bytes)
-            else:
-                with open(fp, "wb") as file:
-                    file.write(self._xml_bytes)
+            self._write_bytes(fp, is_file_object, self._xml_bytes)
+        elif use_graphviz_png:
+            self._write_bytes(fp, is_file_object, self._png_bytes)
         else:
             self._pil_image.save(fp, format, **params)
 
+    def _write_bytes(self, fp, is_file_object, data):
+        if is_file_object:
+            fp.write(data)
+        else:
+            with open(fp, "wb") as file:
+                file.write(data)
+
     def show(self):
         """Show image using PIL"""
         self._pil_image.show()
 
     def _repr_svg_(self):
-        """Rich display image as SVG in IPython notebook or Qt console."""
-        return self._xml_bytes.decode("utf8")
+        """
+        Rich display image as SVG in IPython notebook or Qt console. This only renders
+        SVG, never PNG.
+        """
+        xml_str = self._xml_bytes.decode("utf8")
+        # Graphviz's SVG starts with an XML declaration and doctype, which we don't
+        # need when embedding it in a notebook, so we strip everything before the
+        # <svg> element. This way the same render serves both display and saving.
+        svg_start_ix = xml_str.find("<svg")
+        if svg_start_ix == -1:
+            return xml_str
+        return xml_str[svg_start_ix:]
 
 
-def hpluv_color_dict(keys, saturation, lightness):
+@lru_cache(maxsize=128)
+def hpluv_color_strs(n, saturation, lightness):
     """
-    Given a list of arbitary keys, generates a dict mapping those keys to a set
-    of evenly-spaced, perceptually uniform colors with the specified saturation
-    and lightness.
+    Generates a tuple of n evenly-spaced, perceptually uniform colors with the
+    specified saturation and lightness. The results are cached, since we usually
+    render the same flow (and hence ask for the same palette) many times.
     """
 
-    n = len(keys)
-    color_strs = [
+    return tuple(
         hsluv.hpluv_to_hex([(360 * (i / float(n))), saturation, lightness])
         for i in range(n)
+    )
+
+
+@attr.s(frozen=True)
+class DagElements:
+    """
+    The information needed to draw a flow DAG: its nodes grouped into clusters, one
+    color for each cluster, and each node's name and (optional) tooltip.
+
+    The node names are already wrapped in quotes and can be used directly as DOT IDs.
+    The clusters are in a deterministic order, and the nodes within each cluster are
+    sorted.
+    """
+
+    node_clusters = attr.ib()
+    color_strs = attr.ib()
+    names_by_node = attr.ib()
+    tooltips_by_node = attr.ib()
+
+
+def dag_elements_from_graph(graph):
+    """
+    Given a NetworkX directed acyclic graph, returns a ``DagElements`` object
+    describing how each of its nodes should be drawn.
+    """
+
+    # First, we cluster together any nodes that share an entity name. This includes
+    # nodes generated by a common tuple function, and nodes that differ only by case
+    # key. We give each distinct entity name an integer ID, and merge clusters with a
+    # union-find structure over those IDs, so that merging two clusters doesn't
+    # require copying either of them.
+    name_ids_by_name = {}
+    parent_name_ids = []
+
+    def name_id_from_name(name):
+        name_id = name_ids_by_name.get(name)
+        if name_id is None:
+            name_id = len(parent_name_ids)
+            name_ids_by_name[name] = name_id
+            parent_name_ids.append(name_id)
+        return name_id
+
+    def find_root_name_id(name_id):
+        root_name_id = name_id
+        while parent_name_ids[root_name_id] != root_name_id:
+            root_name_id = parent_name_ids[root_name_id]
+        # Compress the path so that later lookups are fast.
+        while name_id != root_name_id:
+            parent_name_ids[name_id], name_id = root_name_id, parent_name_ids[name_id]
+        return root_name_id
+
+    def union_name_ids(name_id_a, name_id_b):
+        root_name_id_a = find_root_name_id(name_id_a)
+        root_name_id_b = find_root_name_id(name_id_b)
+        if root_name_id_a != root_name_id_b:
+            parent_name_ids[root_name_id_b] = root_name_id_a
+
+    first_name_ids_by_node = {}
+    for node in graph.nodes():
+        entity_names_iter = iter(node.dnode.all_entity_names())
+        # If this node has no entity names at all, we'll pretend it has a single entity
+        # name. (I don't think this can currently happen, because the only descriptor
+        # with no entity names is the empty tuple `()`, and specifying an empty tuple
+        # as an output descriptor ends up doing nothing. Still, we'll try to handle this
+        # gracefully in case things change.)
+        first_name_id = name_id_from_name(next(entity_names_iter, ""))
+
+        # If this node has multiple entity names, we want to make sure all those names
+        # are associated with the same cluster, so we'll merge all their clusters.
+        for other_entity_name in entity_names_iter:
+            union_name_ids(first_name_id, name_id_from_name(other_entity_name))
+        first_name_ids_by_node[node] = first_name_id
+
+    # Once all the merging is done, we can group the nodes by their cluster's root. We
+    # store the clusters in a list, along with a parallel list of the smallest node in
+    # each cluster (which we'll use for sorting).
+    cluster_ixs_by_root_name_id = [None] * len(parent_name_ids)
+    node_clusters = []
+    min_nodes = []
+    for node, name_id in first_name_ids_by_node.items():
+        root_name_id = find_root_name_id(name_id)
+        cluster_ix = cluster_ixs_by_root_name_id[root_name_id]
+        if cluster_ix is None:
+            cluster_ixs_by_root_name_id[root_name_id] = len(node_clusters)
+            node_clusters.append([node])
+            min_nodes.append(node)
+        else:
+            node_clusters[cluster_ix].append(node)
+            if node < min_nodes[cluster_ix]:
+                min_nodes[cluster_ix] = node
+
+    # Now we arrange the clusters in a deterministic order and assign a color to each
+    # one. (The determinism is important so that the colored graph looks the same each
+    # time.)
+    sorted_node_clusters = [
+        sorted(node_clusters[cluster_ix])
+        for cluster_ix in sorted(range(len(node_clusters)), key=min_nodes.__getitem__)
     ]
-    return dict(zip(keys, color_strs))
+    color_strs = list(
+        hpluv_color_strs(len(sorted_node_clusters), saturation=99, lightness=90)
+    )
+
+    # We look up each node's attributes once up front, since NetworkX attribute access
+    # is relatively slow and each name is used once per adjacent edge.
+    names_by_node = {}
+    tooltips_by_node = {}
+    # Many nodes share the same docstring (e.g., all the nodes for an entity with
+    # multiple case keys), so we only rewrap each distinct docstring once.
+    tooltips_by_doc = {}
+    for node, node_attrs in graph.nodes(data=True):
+        # We wrap all names in quotes (escaping any quotes inside them), so that
+        # special characters don't produce invalid DOT code. These quotes aren't
+        # visible in the actual visualization.
+        names_by_node[node] = quote_dot_string(node_attrs["name"])
+        doc = node_attrs.get("doc")
+        if doc:
+            tooltip = tooltips_by_doc.get(doc)
+            if tooltip is None:
+                tooltip = rewrap_docstring(doc)
+                tooltips_by_doc[doc] = tooltip
+            tooltips_by_node[node] = tooltip
+
+    return DagElements(
+        node_clusters=sorted_node_clusters,
+        color_strs=color_strs,
+        names_by_node=names_by_node,
+        tooltips_by_node=tooltips_by_node,
+    )
 
 
 def dot_from_graph(graph, vertical=False, curvy_lines=False, name=None):
@@ -91,84 +343,154 @@ def dot_from_graph(graph, vertical=False, curvy_lines=False, name=None):
         rankdir="TB" if vertical else "LR",
     )
 
-    # First, we cluster together any nodes that share an entity name. This includes
-    # nodes generated by a common tuple function, and nodes that differ only by case
-    # key.
-    node_clusters_by_entity_name = defaultdict(list)
-    for node in graph.nodes():
-        entity_names = list(node.dnode.all_entity_names())
-        # If this node has no entity names at all, we'll pretend it has a single entity
-        # name. (I don't think this can currently happen, because the only descriptor
-        # with no entity names is the empty tuple `()`, and specifying an empty tuple
-        # as an output descriptor ends up doing nothing. Still, we'll try to handle this
-        # gracefully in case things change.)
-        if len(entity_names) == 0:
-            entity_names = [""]
+    elements = dag_elements_from_graph(graph)
+    names_by_node = elements.names_by_node
 
-        # If this node has multiple entity names, we want to make sure all those names
-        # are associated with the same cluster, so we'll merge all the clusters we find.
-        first_cluster = node_clusters_by_entity_name[entity_names[0]]
-        for other_entity_name in entity_names[1:]:
-            other_cluster = node_clusters_by_entity_name[other_entity_name]
-            if other_cluster is not first_cluster:
-                first_cluster.extend(other_cluster)
-                node_clusters_by_entity_name[other_entity_name] = first_cluster
-
-        first_cluster.append(node)
-
-    # Now we deduplicate the clusters, arrange them in a deterministic order, and assign
-    # a color to each one. (The determinism is important so that the colored graph looks
-    # the same each time.)
-    unique_node_clusters_by_obj_id = {
-        id(cluster): cluster for cluster in node_clusters_by_entity_name.values()
-    }
-    sorted_node_clusters = sorted(unique_node_clusters_by_obj_id.values(), key=min)
-    cluster_ixs = list(range(len(sorted_node_clusters)))
-    color_strs_by_cluster_ix = hpluv_color_dict(
-        cluster_ixs,
-        saturation=99,
-        lightness=90,
-    )
-
-    def name_from_node(node):
-        # We wrap all names in quotes; if we don't, pydot will react to special
-        # characters by either adding its own quotes or emitting invalid code. These
-        # quotes aren't visible in the actual visualization.
-        return '"' + (graph.nodes[node]["name"]) + '"'
-
-    def doc_from_node(node):
-        return graph.nodes[node].get("doc")
-
-    for cluster_ix, node_cluster in zip(cluster_ixs, sorted_node_clusters):
+    for cluster_ix, (node_cluster, color) in enumerate(
+        zip(elements.node_clusters, elements.color_strs)
+    ):
         # We use a numerical cluster index instead of something like an entity name
         # because pydot can break if the cluster name constains special characters.
         subdot = pydot.Cluster(str(cluster_ix), style="invis")
-        color = color_strs_by_cluster_ix[cluster_ix]
 
-        for node in sorted(node_cluster):
-            doc = doc_from_node(node)
+        for node in node_cluster:
             dot_node = pydot.Node(
-                name_from_node(node),
+                names_by_node[node],
                 style="filled",
                 fillcolor=color,
                 shape="box",
             )
-            if doc:
-                tooltip = rewrap_docstring(doc)
+            tooltip = elements.tooltips_by_node.get(node)
+            if tooltip is not None:
                 dot_node.set("tooltip", tooltip)
             subdot.add_node(dot_node)
 
         dot.add_subgraph(subdot)
 
-    for pred_node in graph.nodes():
-        for succ_node in graph.successors(pred_node):
-            dot.add_edge(
-                pydot.Edge(
-                    name_from_node(pred_node),
-                    name_from_node(succ_node),
-                    arrowhead="open",
-                    tailport="s" if vertical else "e",
-                )
+    tailport = "s" if vertical else "e"
+    for pred_node, succ_node in graph.edges():
+        dot.add_edge(
+            pydot.Edge(
+                names_by_node[pred_node],
+                names_by_node[succ_node],
+                arrowhead="open",
+                tailport=tailport,
             )
+        )
 
     return dot
+
+
+def quote_dot_string(string):
+    """
+    Wraps a string in double quotes so it can be used as an ID in DOT source,
+    escaping any characters that would otherwise break the syntax.
+    """
+
+    # Backslashes need to be escaped first, so we don't double-escape the backslashes
+    # we add for the other characters.
+    escaped_string = (
+        string.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+    return '"' + escaped_string + '"'
+
+
+def dot_source_from_graph(graph, vertical=False, curvy_lines=False, name=None):
+    """
+    Given a NetworkX directed acyclic graph, returns a string of DOT source code which
+    can be visualized using GraphViz.
+    """
+
+    return dot_source_from_lines(
+        dot_lines_from_graph(
+            graph, vertical=vertical, curvy_lines=curvy_lines, name=name
+        )
+    )
+
+
+def dot_source_from_lines(dot_lines):
+    """
+    Concatenates an iterable of DOT source lines into a single string.
+
+    Unlike ``str.join``, which first collects its whole argument into a list, this
+    consumes the lines one at a time, so it doesn't build an intermediate list of
+    lines. The result is still the complete source in memory.
+    """
+
+    dot_source_buffer = StringIO()
+    dot_source_buffer.writelines(dot_lines)
+    return dot_source_buffer.getvalue()
+
+
+def dot_lines_from_graph(graph, vertical=False, curvy_lines=False, name=None):
+    """
+    Like ``dot_source_from_graph``, but returns an iterator over the lines of DOT
+    source code (each ending with a newline) instead of a single string. The lines
+    are generated on demand, which avoids building an intermediate list of them;
+    however, the current callers all collect them into a single string.
+    """
+
+    if name is None:
+        graph_name = ""
+    else:
+        graph_name = name
+
+    return dot_lines_from_elements(
+        elements=dag_elements_from_graph(graph),
+        edges=graph.edges(),
+        graph_name=graph_name,
+        graph_attrs_str=(
+            f"splines={'spline' if curvy_lines else 'line'}; "
+            "outputorder=edgesfirst; "
+            f"rankdir={'TB' if vertical else 'LR'};"
+        ),
+        edge_attrs_str=f"arrowhead=open, tailport={'s' if vertical else 'e'}",
+    )
+
+
+def dot_lines_from_elements(
+    elements, edges, graph_name, graph_attrs_str, edge_attrs_str
+):
+    """
+    Generates the lines of DOT source code for a DAG, given its ``DagElements``, its
+    edges (as pairs of nodes), and preformatted attribute strings for the whole graph
+    and for each edge.
+
+    This loops over every node and edge, so it dominates the cost of generating the
+    source for large graphs. To keep it fast, each line is built from pieces that are
+    formatted once per cluster (or once overall).
+    """
+
+    names_by_node = elements.names_by_node
+    tooltips_by_node = elements.tooltips_by_node
+
+    yield f"digraph {quote_dot_string(graph_name)} {{\n"
+    yield graph_attrs_str + "\n"
+
+    for cluster_ix, (node_cluster, color) in enumerate(
+        zip(elements.node_clusters, elements.color_strs)
+    ):
+        yield f"subgraph cluster_{cluster_ix} {{ style=invis;\n"
+        node_attrs_prefix = f' [style=filled, fillcolor="{color}", shape=box'
+        for node in node_cluster:
+            tooltip = tooltips_by_node.get(node)
+            if tooltip is None:
+                yield names_by_node[node] + node_attrs_prefix + "];\n"
+            else:
+                yield (
+                    names_by_node[node]
+                    + node_attrs_prefix
+                    + ", tooltip="
+                    + quote_dot_string(tooltip)
+                    + "];\n"
+                )
+        yield "}\n"
+
+    edge_suffix = f" [{edge_attrs_str}];\n"
+    for pred_node, succ_node in edges:
+        yield names_by_node[pred_node] + " -> " + names_by_node[succ_node] + edge_suffix
+
+    yield "}\n"
@@ -1460,13 +1460,13 @@ class Flow:
             include_core=include_core,
             _include_detail=_include_detail,
         )
-        dot = dagviz.dot_from_graph(
+        dot_lines = dagviz.dot_lines_from_graph(
             graph=graph,
             vertical=vertical,
             curvy_lines=curvy_lines,
             name=self.name,
         )
-        return dagviz.FlowImage(dot)
+        return dagviz.FlowImage.from_dot_iter(dot_lines)
 
     def reload(self):
         """
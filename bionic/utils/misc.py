@@ -234,6 +234,9 @@ def rewrap_docstring(docstring):
     docstring = docstring.strip()
     if not docstring:
         return ""
+    # Many docstrings are a single line, which we can usually return as-is.
+    if "\n" not in docstring and not NEW_PARAGRAPH_PATTERN.match(docstring):
+        return docstring
 
     lines = docstring.split("\n")
     grouped_line_lists = [[]]
@@ -6,7 +6,12 @@ import threading
 from bionic.code_hasher import CodeHasher, TypePrefix
 
 
-def test_code_hasher():
+def make_hashable_values():
+    """
+    Returns a list of distinct values, and a list of distinct values with complex types
+    that CodeHasher warns about.
+    """
+
     def barray(value):
         return bytearray(value, "utf8")
 
@@ -167,21 +172,48 @@ def test_code_hasher():
         threading.Lock(),
     ]
 
+    return values, values_with_complex_types
+
+
+VALUES, VALUES_WITH_COMPLEX_TYPES = make_hashable_values()
+ALL_VALUES = VALUES + VALUES_WITH_COMPLEX_TYPES
+
+
+def hash_warning_context(idx):
+    if idx >= len(VALUES):
+        return pytest.warns(UserWarning, match="Found a constant")
+    else:
+        return contextlib.suppress()
+
+
+@pytest.fixture(scope="module")
+def hash_values():
+    """
+    The hash of each value in ALL_VALUES. These are computed once and shared, since
+    CodeHasher is relatively slow.
+    """
+
+    hash_values = []
+    for idx, val in enumerate(ALL_VALUES):
+        with hash_warning_context(idx):
+            hash_values.append(CodeHasher.hash(val))
+    return hash_values
+
+
+def test_code_hasher(hash_values):
     idx_by_hash_value = {}
-    for idx, val in enumerate(values + values_with_complex_types):
-        if idx >= len(values):
-            ctx_mgr = pytest.warns(UserWarning, match="Found a constant")
-        else:
-            ctx_mgr = contextlib.suppress()
-
-        with ctx_mgr:
-            hash_value = CodeHasher.hash(val)
-            # Hashing again should return the same hash value.
-            assert CodeHasher.hash(val) == hash_value
-            assert (
-                hash_value not in idx_by_hash_value
-            ), f"{values[idx]} and {values[idx_by_hash_value[hash_value]]} have the same hash"
-            idx_by_hash_value[hash_value] = idx
+    for idx, hash_value in enumerate(hash_values):
+        assert (
+            hash_value not in idx_by_hash_value
+        ), f"{ALL_VALUES[idx]} and {ALL_VALUES[idx_by_hash_value[hash_value]]} have the same hash"
+        idx_by_hash_value[hash_value] = idx
+
+
+@pytest.mark.parametrize("idx", range(len(ALL_VALUES)))
+def test_code_hasher_is_deterministic(hash_values, idx):
+    # Hashing again should return the same hash value.
+    with hash_warning_context(idx):
+        assert CodeHasher.hash(ALL_VALUES[idx]) == hash_values[idx]
 
 
 def test_complex_type_warning():
@@ -3,8 +3,11 @@ Tests for dagviz and FlowImage class.
 """
 
 import pytest
+from io import BytesIO
 from xml.etree import ElementTree as ET
 from PIL import Image
+import networkx as nx
+import pydot
 
 import bionic as bn
 from bionic import dagviz
@@ -103,6 +106,19 @@ def test_dot_tooltips(flow_dot):
     )
 
 
+def test_dot_edges(flow_graph, flow_dot):
+    edge_name_pairs = {
+        (edge.get_source(), edge.get_destination()) for edge in flow_dot.get_edges()
+    }
+    assert edge_name_pairs == {
+        (
+            dagviz.quote_dot_string(flow_graph.nodes[pred_node]["name"]),
+            dagviz.quote_dot_string(flow_graph.nodes[succ_node]["name"]),
+        )
+        for pred_node, succ_node in flow_graph.edges()
+    }
+
+
 def test_save_flowimage_file_path(tmp_path, flow_image):
     """When a file path is given as input, and type is supported by PIL
     check that output image format is preserved."""
@@ -148,3 +164,166 @@ def test_save_flowimage_file_object_svg(tmp_path, flow_image):
                 output_text
             )
         )
+
+
+# Graphviz's SVG output includes an XML declaration before the <svg> element.
+FAKE_SVG_BYTES = b'<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<svg></svg>'
+
+
+@pytest.fixture
+def rendered_format_lists(monkeypatch):
+    """
+    Replaces Graphviz with a fake renderer, and returns a list that records the
+    formats requested by each call to it.
+    """
+
+    rendered_format_lists = []
+
+    def fake_run_graphviz(dot_source, output_formats):
+        rendered_format_lists.append(list(output_formats))
+        bytes_by_format = {}
+        for output_format in output_formats:
+            if output_format == "svg":
+                bytes_by_format["svg"] = FAKE_SVG_BYTES
+            else:
+                png_file = BytesIO()
+                Image.new("RGB", (1, 1)).save(png_file, format="png")
+                bytes_by_format[output_format] = png_file.getvalue()
+        return bytes_by_format
+
+    monkeypatch.setattr(dagviz, "run_graphviz", fake_run_graphviz)
+    return rendered_format_lists
+
+
+def test_flowimage_renders_lazily(tmp_path, flow_dot, rendered_format_lists):
+    flow_image = dagviz.FlowImage(flow_dot)
+    assert rendered_format_lists == []
+
+    assert flow_image._repr_svg_() == "<svg></svg>"
+    flow_image.save(tmp_path / "test.svg")
+    flow_image._repr_svg_()
+    assert (tmp_path / "test.svg").read_bytes() == FAKE_SVG_BYTES
+    assert rendered_format_lists == [["svg"]]
+
+    flow_image.save(tmp_path / "test.png")
+    flow_image.save(tmp_path / "test2.png")
+    assert rendered_format_lists == [["svg"], ["png"]]
+
+
+def test_flowimage_renders_png_with_svg(tmp_path, flow_dot, rendered_format_lists):
+    flow_image = dagviz.FlowImage(flow_dot)
+
+    flow_image.save(tmp_path / "test.png")
+    flow_image.save(tmp_path / "test.svg")
+    flow_image._repr_svg_()
+    assert rendered_format_lists == [["png", "svg"]]
+
+
+def test_dot_source_matches_dot(flow_graph, flow_dot):
+    def node_attrs_by_name_from_dot_source(dot_source):
+        (dot,) = pydot.graph_from_dot_data(dot_source)
+        return {
+            name: node.get_attributes()
+            for name, node in nodes_by_name_from_dot(dot).items()
+        }
+
+    dot_source = dagviz.dot_source_from_graph(flow_graph)
+    assert node_attrs_by_name_from_dot_source(
+        dot_source
+    ) == node_attrs_by_name_from_dot_source(flow_dot.to_string())
+
+    (parsed_dot,) = pydot.graph_from_dot_data(dot_source)
+    assert len(parsed_dot.get_edges()) == len(flow_dot.get_edges())
+
+
+@pytest.mark.parametrize(
+    "string, quoted_string",
+    [
+        ("", '""'),
+        ("name", '"name"'),
+        ('say "hi"', '"say \\"hi\\""'),
+        ("two\nlines", '"two\\nlines"'),
+        ("C:\\", '"C:\\\\"'),
+        ('back\\"slash', '"back\\\\\\"slash"'),
+    ],
+)
+def test_quote_dot_string(string, quoted_string):
+    assert dagviz.quote_dot_string(string) == quoted_string
+
+    (dot,) = pydot.graph_from_dot_data(f"digraph {{ x [tooltip={quoted_string}]; }}")
+    assert dot.get_nodes()[0].get_tooltip() == quoted_string
+
+
+def test_save_flowimage_file_like_object_svg(flow_dot, rendered_format_lists):
+    """When a file-like object that isn't an IOBase is given, it's still written to"""
+
+    class FileLike:
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, chunk):
+            self.chunks.append(chunk)
+
+    file_like = FileLike()
+    dagviz.FlowImage(flow_dot).save(file_like, format="svg")
+    assert file_like.chunks == [FAKE_SVG_BYTES]
+
+
+@pytest.mark.parametrize("filename", ["test.svg", "test.SVG"])
+def test_save_flowimage_svg_suffix(tmp_path, flow_dot, rendered_format_lists, filename):
+    dagviz.FlowImage(flow_dot).save(str(tmp_path / filename))
+    assert (tmp_path / filename).read_bytes() == FAKE_SVG_BYTES
+    assert rendered_format_lists == [["svg"]]
+
+
+def test_save_flowimage_png_skips_pil(tmp_path, flow_dot, rendered_format_lists):
+    flow_image = dagviz.FlowImage(flow_dot)
+    flow_image.save(tmp_path / "test.png")
+    with open(tmp_path / "test2.png", "wb") as file_object:
+        flow_image.save(file_object, format="PNG")
+    assert flow_image._cached_pil_image is None
+    assert Image.open(tmp_path / "test.png").format == "PNG"
+    assert Image.open(tmp_path / "test2.png").format == "PNG"
+
+    flow_image.save(tmp_path / "test.jpg")
+    assert flow_image._cached_pil_image is not None
+    assert Image.open(tmp_path / "test.jpg").format == "JPEG"
+    assert rendered_format_lists == [["png", "svg"]]
+
+
+def test_render_dag_from_dot_lines(flow, flow_graph, rendered_format_lists):
+    dot_lines = list(dagviz.dot_lines_from_graph(flow_graph, name=flow.name))
+    assert all(line.endswith("\n") for line in dot_lines)
+
+    dot_source = dagviz.dot_source_from_graph(flow_graph, name=flow.name)
+    assert "".join(dot_lines) == dot_source
+    assert dagviz.dot_source_from_lines(iter(dot_lines)) == dot_source
+
+    flow_image = flow.render_dag()
+    assert flow_image._dot_source == dot_source
+    assert flow_image._repr_svg_() == "<svg></svg>"
+    assert rendered_format_lists == [["svg"]]
+
+
+def test_dot_from_empty_graph():
+    elements = dagviz.dag_elements_from_graph(nx.DiGraph())
+    assert elements.node_clusters == []
+    assert elements.color_strs == []
+
+    (dot,) = pydot.graph_from_dot_data(dagviz.dot_source_from_graph(nx.DiGraph()))
+    assert dot.get_subgraphs() == []
+    assert dot.get_edges() == []
+
+
+def test_flowimage_needs_exactly_one_source(flow_dot):
+    with pytest.raises(ValueError):
+        dagviz.FlowImage()
+    with pytest.raises(ValueError):
+        dagviz.FlowImage(flow_dot, dot_source=flow_dot.to_string())
+
+
+def test_save_flowimage_uppercase_svg_format(flow_dot, rendered_format_lists):
+    file_object = BytesIO()
+    dagviz.FlowImage(flow_dot).save(file_object, format="SVG")
+    assert file_object.getvalue() == FAKE_SVG_BYTES
+    assert rendered_format_lists == [["svg"]]
@@ -119,6 +119,8 @@ def test_clean_docstring():
     assert rewrap_docstring("test one two") == "test one two"
     assert rewrap_docstring("test\none\ntwo") == "test one two"
     assert rewrap_docstring("test 1. 2.") == "test 1. 2."
+    assert rewrap_docstring("  test  ") == "test"
+    assert rewrap_docstring("- test") == "\n- test"
     assert rewrap_docstring("test\n\none\ntwo") == "test\none two"
 
     doc = """